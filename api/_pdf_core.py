@@ -0,0 +1,416 @@
+# Shared PDF processing used by the process-pdf handlers.
+# The leading underscore keeps Vercel from deploying this file as its own
+# function; handlers import it, so a warm container loads fitz, numpy and the
+# OpenAI client once.
+
+import asyncio
+import hashlib
+import logging
+import os
+import queue
+import random
+import sys
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple
+
+import fitz  # PyMuPDF
+import httpx
+import numpy as np
+import orjson
+from openai import APIConnectionError, AsyncOpenAI, BadRequestError, InternalServerError, OpenAI, RateLimitError
+
+# Configure logging (stdout only: Vercel's filesystem is read-only).
+# Production defaults to WARNING; set LOG_LEVEL=DEBUG to see per-chunk details.
+DEFAULT_LOG_LEVEL = "WARNING" if os.getenv("VERCEL") else "INFO"
+log_level = (os.getenv("LOG_LEVEL") or DEFAULT_LOG_LEVEL).strip().upper()
+# getLevelName maps known names to their number; anything else would make basicConfig raise
+log_level_valid = isinstance(logging.getLevelName(log_level), int)
+logging.basicConfig(
+    level=log_level if log_level_valid else DEFAULT_LOG_LEVEL,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    stream=sys.stdout,
+)
+logger = logging.getLogger(__name__)
+if not log_level_valid:
+    logger.warning(f"Unknown LOG_LEVEL {os.getenv('LOG_LEVEL')!r}, using {DEFAULT_LOG_LEVEL}")
+
+# Initialize OpenAI: a sync client for the BaseHTTPRequestHandler and an async
+# one for the FastAPI app, so embedding requests never block its event loop.
+# Keep connections alive across warm invocations so later requests skip the
+# TLS handshake; HTTP/2 multiplexes concurrent batches over one connection.
+# SDK retries are off: _embed_batch/_aembed_batch own the rate-limit backoff
+HTTP_LIMITS = httpx.Limits(max_keepalive_connections=20, max_connections=50, keepalive_expiry=60.0)
+try:
+    http_client = httpx.Client(limits=HTTP_LIMITS, http2=True)
+    client = OpenAI(api_key=os.getenv("OPENAI_API_KEY", ""), http_client=http_client, max_retries=0)
+    async_http_client = httpx.AsyncClient(limits=HTTP_LIMITS, http2=True)
+    async_client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY", ""), http_client=async_http_client, max_retries=0)
+    logger.info("OpenAI clients initialized")
+except Exception as e:
+    logger.error(f"OpenAI init failed: {e}")
+    client = None
+    async_client = None
+
+EMBEDDING_MODEL = "text-embedding-3-small"
+# Inputs per embeddings request (the API accepts up to 2048)
+BATCH_SIZE = 128
+# Embedding requests kept in flight at once
+MAX_CONCURRENT_BATCHES = 5
+MAX_RATE_LIMIT_RETRIES = 3
+# Failures the SDK would have retried itself (429s, 5xx, timeouts, dropped connections)
+RETRYABLE_ERRORS = (RateLimitError, InternalServerError, APIConnectionError)
+# Longest single backoff, whatever Retry-After asks for
+MAX_RETRY_DELAY = 10.0
+# Seconds a request may spend embedding before retries stop (vercel.json allows the function 60)
+EMBEDDING_TIME_BUDGET = 45.0
+# Embeddings kept in memory so warm invocations skip repeated text
+EMBEDDING_CACHE_SIZE = 10000
+# Extracted batches allowed to wait for an embedding worker
+PIPELINE_DEPTH = 4
+# The default "blocks" flags (TEXTFLAGS_TEXT, which already leaves out images) minus
+# ligature and whitespace preservation. Ligatures are expanded ("ﬁ" -> "fi"), which
+# changes textContent and so the embeddings; whitespace is normalized below anyway
+TEXT_FLAGS = fitz.TEXTFLAGS_TEXT & ~(fitz.TEXT_PRESERVE_LIGATURES | fitz.TEXT_PRESERVE_WHITESPACE)
+
+# LRU of sha256(model + text) -> float32 embedding, shared by embedding threads
+_embedding_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def _cache_key(text):
+    """Cache key for text, including the model so a model switch never reuses stale vectors"""
+    return hashlib.sha256(f"{EMBEDDING_MODEL}\0{text}".encode()).digest()
+
+
+def _cache_get(key):
+    with _cache_lock:
+        embedding = _embedding_cache.get(key)
+        if embedding is not None:
+            _embedding_cache.move_to_end(key)
+        return embedding
+
+
+def _cache_put(key, embedding):
+    with _cache_lock:
+        _embedding_cache[key] = embedding
+        _embedding_cache.move_to_end(key)
+        if len(_embedding_cache) > EMBEDDING_CACHE_SIZE:
+            _embedding_cache.popitem(last=False)
+
+
+def _embed_one(text):
+    """Generate embedding for a single text, used when a batch is rejected"""
+    try:
+        response = client.embeddings.create(input=text, model=EMBEDDING_MODEL)
+        return response.data[0].embedding
+    except Exception as e:
+        logger.error(f"Embedding error: {e}")
+        return None
+
+
+def _retry_delay(error, attempt):
+    """Seconds to wait before retrying: Retry-After if given, else jittered backoff, capped at MAX_RETRY_DELAY"""
+    try:
+        delay = float(error.response.headers.get("retry-after"))
+    except (AttributeError, TypeError, ValueError):
+        delay = 2 ** attempt + random.uniform(0, 1)
+    return min(max(delay, 0.0), MAX_RETRY_DELAY)
+
+
+def _embed_batch(batch, deadline):
+    """Embed one batch, backing off independently of other batches on transient errors.
+
+    No retry starts if its backoff would run past deadline (a time.monotonic()
+    value), so a rate-limited request still answers before the function times out.
+    """
+    # Stagger requests so concurrent batches don't hit the API in lockstep
+    time.sleep(random.uniform(0, 0.05))
+    for attempt in range(MAX_RATE_LIMIT_RETRIES + 1):
+        try:
+            response = client.embeddings.create(input=batch, model=EMBEDDING_MODEL)
+            return [item.embedding for item in response.data]
+        except RETRYABLE_ERRORS as e:
+            if attempt == MAX_RATE_LIMIT_RETRIES:
+                logger.error(f"Embedding failed after retries, giving up: {e}")
+                return [None] * len(batch)
+            delay = _retry_delay(e, attempt)
+            if time.monotonic() + delay > deadline:
+                logger.error(f"Embedding out of time budget, giving up: {e}")
+                return [None] * len(batch)
+            logger.warning(f"Embedding request failed, retrying in {delay:.1f}s: {e}")
+            time.sleep(delay)
+        except BadRequestError as e:
+            logger.error(f"Batch embedding rejected, retrying per text: {e}")
+            return [_embed_one(text) for text in batch]
+        except Exception as e:
+            logger.error(f"Embedding error: {e}")
+            return [None] * len(batch)
+
+
+def _cache_lookup(texts):
+    """Return (keys, embeddings, misses): cached embeddings filled in, misses indexing the rest"""
+    keys = [_cache_key(text) for text in texts]
+    embeddings = [_cache_get(key) for key in keys]
+    misses = [i for i, embedding in enumerate(embeddings) if embedding is None]
+    return keys, embeddings, misses
+
+
+def _cache_fill(keys, embeddings, misses, fresh):
+    """Store freshly fetched embeddings for misses in the cache and in embeddings"""
+    for i, embedding in zip(misses, fresh):
+        if embedding is not None:
+            embeddings[i] = array("f", embedding)
+            _cache_put(keys[i], embeddings[i])
+
+
+def generate_embeddings_batch(texts, deadline):
+    """Embed one batch of at most BATCH_SIZE texts, only calling OpenAI for texts not already cached.
+
+    Concurrency across batches is the caller's job (see process_pdf_bytes).
+    Headers, footers and boilerplate repeat within and across PDFs; cached
+    vectors are stored as float32 arrays to keep the cache small, and those
+    arrays are what is returned (None where embedding failed).
+    """
+    keys, embeddings, misses = _cache_lookup(texts)
+    if misses and client:
+        _cache_fill(keys, embeddings, misses, _embed_batch([texts[i] for i in misses], deadline))
+    return embeddings
+
+
+async def _aembed_one(text):
+    """Async _embed_one"""
+    try:
+        response = await async_client.embeddings.create(input=text, model=EMBEDDING_MODEL)
+        return response.data[0].embedding
+    except Exception as e:
+        logger.error(f"Embedding error: {e}")
+        return None
+
+
+async def _aembed_batch(batch, deadline):
+    """Async _embed_batch: same jitter, rate-limit backoff and per-text fallback"""
+    await asyncio.sleep(random.uniform(0, 0.05))
+    for attempt in range(MAX_RATE_LIMIT_RETRIES + 1):
+        try:
+            response = await async_client.embeddings.create(input=batch, model=EMBEDDING_MODEL)
+            return [item.embedding for item in response.data]
+        except RETRYABLE_ERRORS as e:
+            if attempt == MAX_RATE_LIMIT_RETRIES:
+                logger.error(f"Embedding failed after retries, giving up: {e}")
+                return [None] * len(batch)
+            delay = _retry_delay(e, attempt)
+            if time.monotonic() + delay > deadline:
+                logger.error(f"Embedding out of time budget, giving up: {e}")
+                return [None] * len(batch)
+            logger.warning(f"Embedding request failed, retrying in {delay:.1f}s: {e}")
+            await asyncio.sleep(delay)
+        except BadRequestError as e:
+            logger.error(f"Batch embedding rejected, retrying per text: {e}")
+            return [await _aembed_one(text) for text in batch]
+        except Exception as e:
+            logger.error(f"Embedding error: {e}")
+            return [None] * len(batch)
+
+
+async def agenerate_embeddings_batch(texts, semaphore, deadline):
+    """Async generate_embeddings_batch for one batch of at most BATCH_SIZE texts; semaphore bounds in-flight requests"""
+    keys, embeddings, misses = _cache_lookup(texts)
+    if misses and async_client:
+        async with semaphore:
+            fresh = await _aembed_batch([texts[i] for i in misses], deadline)
+        _cache_fill(keys, embeddings, misses, fresh)
+    return embeddings
+
+
+def iter_chunks(doc):
+    """Yield (page_num, bbox, clean_text) for meaningful text blocks, in page order.
+
+    Short fragments are dropped here, so callers only ever see keepers and
+    build their per-chunk structures once.
+    """
+    for page_num in range(doc.page_count):
+        # A block is roughly equivalent to a paragraph.
+        # TEXT_FLAGS has no TEXT_PRESERVE_IMAGES, so every block is a text block
+        for x0, y0, x1, y1, text, _, _ in doc[page_num].get_text("blocks", flags=TEXT_FLAGS):
+            # Normalizing only shrinks text, so short raw blocks can't pass the check below
+            if len(text) <= 20:
+                continue
+
+            clean_text = " ".join(text.split())
+
+            # Only store chunks with meaningful text content
+            if len(clean_text) > 20:
+                yield page_num, (x0, y0, x1, y1), clean_text
+
+
+def extract_chunks(pdf_bytes):
+    """Yield chunks from every page, in page order.
+
+    Extraction stays in-process on the extractor thread, where it already
+    overlaps with embedding. A process pool never paid for itself: each
+    segment has to reopen the PDF and pickle its chunks back, which cost
+    more than the pages themselves take to extract, and Lambda has no
+    /dev/shm for the pool to start anyway.
+    """
+    with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
+        yield from iter_chunks(doc)
+
+
+class ChunkArrays(NamedTuple):
+    """Struct-of-arrays view of a processed PDF; row i of page/bbox/text_idx is chunk i.
+
+    A bbox row is 16 bytes instead of a ~300 byte dict, and a float16
+    embedding row is a quarter the size of the float list it replaces.
+    """
+    page: np.ndarray  # (n,) int32, 0-based page number
+    bbox: np.ndarray  # (n, 4) float32 x0, y0, x1, y1
+    text_idx: np.ndarray  # (n,) int32 row into texts / embeddings
+    texts: list
+    embeddings: np.ndarray  # (len(texts), dim) float16
+    has_embedding: np.ndarray  # (len(texts),) bool
+
+
+def pack_chunks(pending, texts, embeddings):
+    """Pack (page_num, bbox, text_idx) tuples and per-text embeddings into ChunkArrays.
+
+    Embeddings are stored as float16. OpenAI embeddings are unit-normalized,
+    so the precision loss (~0.001 in cosine similarity) is negligible for
+    retrieval, and orjson writes float16 values with far fewer digits than
+    Python floats.
+    """
+    n = len(pending)
+    page = np.fromiter((page_num for page_num, _, _ in pending), dtype=np.int32, count=n)
+    bbox = np.array([bbox for _, bbox, _ in pending], dtype=np.float32).reshape(n, 4)
+    text_idx = np.fromiter((idx for _, _, idx in pending), dtype=np.int32, count=n)
+    dim = next((len(e) for e in embeddings if e is not None), 0)
+    matrix = np.zeros((len(texts), dim), dtype=np.float16)
+    has_embedding = np.zeros(len(texts), dtype=bool)
+    for i, embedding in enumerate(embeddings):
+        if embedding is not None:
+            matrix[i] = np.frombuffer(embedding, dtype=np.float32)
+            has_embedding[i] = True
+    return ChunkArrays(page, bbox, text_idx, texts, matrix, has_embedding)
+
+
+class _Extractor(threading.Thread):
+    """Runs extract_chunks in the background, queueing each BATCH_SIZE run of new distinct texts.
+
+    Identical blocks (TOCs, footers, "Page X of Y") are embedded once and the
+    result fanned back out to every occurrence: pending holds
+    (page_num, bbox, text_idx) and batches carries (start_idx, texts) so
+    results can be placed back by index. None on the queue marks the end.
+    """
+
+    def __init__(self, pdf_bytes):
+        super().__init__(daemon=True)
+        self.pdf_bytes = pdf_bytes
+        self.unique = {}
+        self.pending = []
+        self.batches = queue.Queue(maxsize=PIPELINE_DEPTH)
+        self.error = None
+
+    def run(self):
+        batch_start = 0
+        batch = []
+        try:
+            for page_num, bbox, clean_text in extract_chunks(self.pdf_bytes):
+                text_idx = self.unique.setdefault(clean_text, len(self.unique))
+                self.pending.append((page_num, bbox, text_idx))
+                if text_idx == batch_start + len(batch):  # first occurrence
+                    batch.append(clean_text)
+                    if len(batch) == BATCH_SIZE:
+                        self.batches.put((batch_start, batch))
+                        batch_start, batch = batch_start + len(batch), []
+            if batch:
+                self.batches.put((batch_start, batch))
+        except Exception as e:
+            self.error = e
+        finally:
+            self.batches.put(None)
+
+    def result(self, embeddings):
+        """Pack the extracted chunks with their embeddings once the thread has finished"""
+        if self.error:
+            raise self.error
+        return pack_chunks(self.pending, list(self.unique), embeddings)
+
+
+def process_pdf_bytes(pdf_bytes):
+    """Extract chunks from a PDF and embed them, overlapping the two phases.
+
+    The embedding pool picks batches up from the extractor while later pages
+    are still being extracted. Returns the chunks packed as ChunkArrays.
+    """
+    deadline = time.monotonic() + EMBEDDING_TIME_BUDGET
+    extractor = _Extractor(pdf_bytes)
+    extractor.start()
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_BATCHES) as executor:
+        futures = []
+        while (item := extractor.batches.get()) is not None:
+            batch_start, batch = item
+            futures.append((batch_start, executor.submit(generate_embeddings_batch, batch, deadline)))
+        embeddings = [None] * len(extractor.unique)
+        for batch_start, future in futures:
+            result = future.result()
+            embeddings[batch_start:batch_start + len(result)] = result
+    extractor.join()
+    return extractor.result(embeddings)
+
+
+async def aprocess_pdf_bytes(pdf_bytes):
+    """Async process_pdf_bytes for the FastAPI app.
+
+    Each batch becomes an embedding task on the event loop as soon as the
+    extractor queues it, with one semaphore capping in-flight requests at
+    MAX_CONCURRENT_BATCHES; waiting on the extractor happens off the loop.
+    """
+    deadline = time.monotonic() + EMBEDDING_TIME_BUDGET
+    extractor = _Extractor(pdf_bytes)
+    extractor.start()
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_BATCHES)
+    tasks = []
+    while (item := await asyncio.to_thread(extractor.batches.get)) is not None:
+        batch_start, batch = item
+        tasks.append((batch_start, asyncio.create_task(agenerate_embeddings_batch(batch, semaphore, deadline))))
+    embeddings = [None] * len(extractor.unique)
+    for batch_start, task in tasks:
+        result = await task
+        embeddings[batch_start:batch_start + len(result)] = result
+    await asyncio.to_thread(extractor.join)
+    return extractor.result(embeddings)
+
+
+def iter_chunk_dicts(arrays):
+    """Yield each chunk as the JSON object the upload route expects, in extraction order"""
+    for page_num, (x0, y0, x1, y1), idx in zip(arrays.page.tolist(), arrays.bbox.tolist(), arrays.text_idx.tolist()):
+        clean_text = arrays.texts[idx]
+        embedding = arrays.embeddings[idx] if arrays.has_embedding[idx] else None
+        logger.debug(
+            "Chunk on page %d, bbox=(%s, %s, %s, %s), embedding=%s: %.100s",
+            page_num + 1, x0, y0, x1, y1, embedding is not None, clean_text,
+        )
+        yield {
+            "pageNumber": page_num + 1,
+            "textContent": clean_text,
+            "bboxList": [{"x0": x0, "y0": y0, "x1": x1, "y1": y1}],
+            "embedding": embedding,  # float16 OpenAI embedding vector (1536 dimensions)
+        }
+
+
+def stream_chunks_json(filename, arrays):
+    """Serialize {"filename": ..., "chunks": [...]} one chunk at a time.
+
+    Avoids holding the whole response (several MB of embedding floats for a
+    large PDF) as a single string; orjson also formats floats far faster
+    than the stdlib encoder.
+    """
+    yield b'{"filename":' + orjson.dumps(filename) + b',"chunks":['
+    sep = b''
+    for chunk in iter_chunk_dicts(arrays):
+        yield sep + orjson.dumps(chunk, option=orjson.OPT_SERIALIZE_NUMPY)
+        sep = b','
+    yield b']}'
@@ -1,36 +1,19 @@
-import cgi
-import io
-import json
 import logging
 import os
 import sys
 from http.server import BaseHTTPRequestHandler
 
-import fitz  # PyMuPDF
-from openai import OpenAI
+import orjson
+from python_multipart import MultipartParser
 
-# Configure logging
-logging.basicConfig(level=logging.INFO, stream=sys.stdout)
-logger = logging.getLogger(__name__)
-
-# Initialize OpenAI
-try:
-    client = OpenAI(api_key=os.getenv("OPENAI_API_KEY", ""))
-    logger.info("OpenAI client initialized")
-except Exception as e:
-    logger.error(f"OpenAI init failed: {e}")
-    client = None
+# Shared extraction/embedding code lives next to this file
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from _pdf_core import process_pdf_bytes, stream_chunks_json  # noqa: E402
 
+logger = logging.getLogger(__name__)
 
-def generate_embedding(text):
-    if not client:
-        return None
-    try:
-        response = client.embeddings.create(input=text, model="text-embedding-3-small")
-        return response.data[0].embedding
-    except Exception as e:
-        logger.error(f"Embedding error: {e}")
-        return None
+# Bytes read from the request body per multipart parser write
+READ_CHUNK_SIZE = 64 * 1024
 
 
 class handler(BaseHTTPRequestHandler):
@@ -46,9 +29,6 @@ class handler(BaseHTTPRequestHandler):
                 self.send_json_response(400, {"error": "No data"})
                 return
             
-            # Read body
-            body = self.rfile.read(content_length)
-            
             # Parse multipart
             content_type = self.headers.get('Content-Type', '')
             logger.info(f"Content-Type: {content_type}")
@@ -58,11 +38,11 @@ class handler(BaseHTTPRequestHandler):
                 return
             
             # Extract boundary
-            boundary = content_type.split('boundary=')[-1].strip()
+            boundary = content_type.split('boundary=')[-1].strip().strip('"')
             logger.info(f"Boundary: {boundary}")
             
-            # Parse file from multipart data
-            pdf_data = self.extract_pdf_from_multipart(body, boundary)
+            # Parse file from multipart data as the body is read
+            pdf_data = self.read_pdf_from_multipart(boundary, content_length)
             
             if not pdf_data:
                 self.send_json_response(400, {"error": "No PDF file found"})
@@ -71,31 +51,10 @@ class handler(BaseHTTPRequestHandler):
             logger.info(f"PDF data extracted: {len(pdf_data)} bytes")
             
             # Process PDF
-            doc = fitz.open(stream=pdf_data, filetype="pdf")
-            chunks = []
+            arrays = process_pdf_bytes(pdf_data)
+            logger.info(f"Processed {len(arrays.page)} chunks")
             
-            for page_num, page in enumerate(doc):
-                blocks = page.get_text("blocks")
-                for block in blocks:
-                    x0, y0, x1, y1, text, _, _ = block
-                    clean_text = " ".join(text.strip().split())
-                    
-                    if len(clean_text) > 20:
-                        embedding = generate_embedding(clean_text)
-                        chunks.append({
-                            "pageNumber": page_num + 1,
-                            "textContent": clean_text,
-                            "bboxList": [{"x0": x0, "y0": y0, "x1": x1, "y1": y1}],
-                            "embedding": embedding,
-                        })
-            
-            doc.close()
-            logger.info(f"Processed {len(chunks)} chunks")
-            
-            self.send_json_response(200, {
-                "filename": "document.pdf",
-                "chunks": chunks
-            })
+            self.send_chunks_response("document.pdf", arrays)
             
         except Exception as e:
             logger.error(f"Error: {e}")
@@ -107,23 +66,64 @@ class handler(BaseHTTPRequestHandler):
         self.send_response(status_code)
         self.send_header('Content-Type', 'application/json')
         self.end_headers()
-        self.wfile.write(json.dumps(data).encode())
+        self.wfile.write(orjson.dumps(data))
     
-    def extract_pdf_from_multipart(self, body, boundary):
-        """Extract PDF data from multipart/form-data"""
+    def send_chunks_response(self, filename, arrays):
+        """Stream the chunks array one element at a time instead of one big dump"""
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
         try:
-            parts = body.split(f'--{boundary}'.encode())
-            for part in parts:
-                if b'Content-Type: application/pdf' in part or b'filename=' in part:
-                    # Find data after headers
-                    header_end = part.find(b'\r\n\r\n')
-                    if header_end != -1:
-                        data_start = header_end + 4
-                        data_end = part.rfind(b'\r\n')
-                        if data_end == -1:
-                            data_end = len(part)
-                        return part[data_start:data_end]
-            return None
+            for piece in stream_chunks_json(filename, arrays):
+                self.wfile.write(piece)
+        except Exception as e:
+            # The 200 and part of the body are already out, so a JSON error
+            # response can't follow; drop the connection to truncate the body
+            logger.error(f"Streaming response failed: {e}")
+            self.close_connection = True
+    
+    def read_pdf_from_multipart(self, boundary, content_length):
+        """Stream multipart/form-data from rfile, keeping only the first PDF part"""
+        pdf_data = bytearray()
+        part = {"headers": b"", "is_pdf": False, "done": False}
+        
+        def on_part_begin():
+            part["headers"] = b""
+        
+        def on_header(data, start, end):
+            part["headers"] += data[start:end]
+        
+        def on_headers_finished():
+            headers = part["headers"]
+            part["is_pdf"] = not part["done"] and (b"application/pdf" in headers or b"filename=" in headers)
+        
+        def on_part_data(data, start, end):
+            if part["is_pdf"]:
+                pdf_data.extend(data[start:end])
+        
+        def on_part_end():
+            if part["is_pdf"]:
+                part["is_pdf"] = False
+                part["done"] = True
+        
+        try:
+            parser = MultipartParser(boundary, callbacks={
+                "on_part_begin": on_part_begin,
+                "on_header_field": on_header,
+                "on_header_value": on_header,
+                "on_headers_finished": on_headers_finished,
+                "on_part_data": on_part_data,
+                "on_part_end": on_part_end,
+            })
+            remaining = content_length
+            # Stop reading as soon as the PDF part is complete
+            while remaining > 0 and not part["done"]:
+                data = self.rfile.read(min(remaining, READ_CHUNK_SIZE))
+                if not data:
+                    break
+                parser.write(data)
+                remaining -= len(data)
+            return pdf_data or None
         except Exception as e:
             logger.error(f"Multipart parsing error: {e}")
             return None